@@ -42,8 +42,15 @@ import subprocess
 import botocore
 import logging
 import time
+import shutil
 from pathlib import Path
 
+# zstandard is only needed when the workunits were written as .tar.zst
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 # Given a config file, parse out all of the configuration options
 
@@ -131,37 +138,54 @@ def get_config_file(temp_dir, s3, bucket_name, object_name):
 
 # Get only the collection information with the subjob specified
 
-def get_subjob(ctx, workunit_id, subjob_id):
+def get_subjob(ctx, workunit_id, subjob_id, tasks_extension):
     # Download from S3
 
+    if(tasks_extension == "tar.zst" and zstandard == None):
+        logging.error(
+            "Workunits were compressed with zstd, but the zstandard package is not installed in this container")
+        return None
+
+    tasks_file = f"{workunit_id}.{tasks_extension}"
+
     input_path = [
         ctx['config']['object_store_job_data_prefix'],
         "input",
         "tasks",
-        f"{workunit_id}.tar.gz"
+        tasks_file
     ]
     object_name = "/".join(input_path)
 
     try:
-        with open(f"{ctx['temp_dir']}/{workunit_id}.tar.gz", 'wb') as f:
+        with open(f"{ctx['temp_dir']}/{tasks_file}", 'wb') as f:
             ctx['s3'].download_fileobj(
                 ctx['config']['object_store_bucket'], object_name, f)
     except botocore.exceptions.ClientError as error:
         logging.error(
-            f"Failed to download from S3 {ctx['config']['object_store_bucket']}/{object_name} to {ctx['temp_dir']}/{workunit_id}.tar.gz, ({error})")
+            f"Failed to download from S3 {ctx['config']['object_store_bucket']}/{object_name} to {ctx['temp_dir']}/{tasks_file}, ({error})")
         return None
 
     os.chdir(f"{ctx['temp_dir']}")
 
     # Get the file with the specific workunit we need to work on
+    subjob = None
     try:
-        tar = tarfile.open(f"{workunit_id}.tar.gz")
-        file = tar.extractfile(f"vf_tasks/{subjob_id}.json")
-        subjob = json.load(file)
-        tar.close()
+        if(tasks_extension == "tar.zst"):
+            with open(tasks_file, 'rb') as f, zstandard.ZstdDecompressor().stream_reader(f) as reader:
+                tar = tarfile.open(fileobj=reader, mode='r|')
+                for member in tar:
+                    if(member.name == f"vf_tasks/{subjob_id}.json"):
+                        subjob = json.load(tar.extractfile(member))
+                        break
+                tar.close()
+        else:
+            tar = tarfile.open(tasks_file)
+            file = tar.extractfile(f"vf_tasks/{subjob_id}.json")
+            subjob = json.load(file)
+            tar.close()
     except Exception as err:
         logging.error(
-            f"ERR: Cannot open {workunit_id}.tar.gz. type: {str(type(err))}, err: {str(err)}")
+            f"ERR: Cannot open {tasks_file}. type: {str(type(err))}, err: {str(err)}")
         return None
 
     return subjob
@@ -305,7 +329,7 @@ def preprocess_collection(ctx, collection_full_name, collection_count):
     subtasklist = []
 
     collection_tranche = collection_full_name[:2]
-    collection_name, collection_number = collection_full_name.split("_", 1)
+    collection_name, _, collection_number = collection_full_name.partition("_")
 
     specific_collection_path = os.path.join(
         ctx['config']['collection_working_path'], f"{collection_name}")
@@ -480,6 +504,7 @@ def process(ctx):
     subjob_id = os.getenv('AWS_BATCH_JOB_ARRAY_INDEX')
     vcpus_to_use = os.getenv('VF_CONTAINER_VCPUS')
     actual_subjobs_count = int(os.getenv('VF_MAX_SUBJOBS'))
+    tasks_extension = os.getenv('VF_TASKS_EXTENSION', 'tar.gz')
 
     # AWS Batch only allows array jobs with at least 2 elements. Since we can end 
     # up with a single job, let's see if we can exit gracefully if we are the 
@@ -490,7 +515,7 @@ def process(ctx):
         exit(0)
 
 
-    subjob = get_subjob(ctx, workunit_id, subjob_id)
+    subjob = get_subjob(ctx, workunit_id, subjob_id, tasks_extension)
     if(subjob == None):
         logging.error("Could not open subjob information")
         exit(1)
@@ -772,8 +797,29 @@ def copy_output(ctx, obj):
 def generate_tarfile(ctx, dir):
     os.chdir(str(Path(dir).parents[0]))
 
-    with tarfile.open(f"{os.path.basename(dir)}.tar.gz", "x:gz") as tar:
-        tar.add(os.path.basename(dir))
+    tarball = f"{os.path.basename(dir)}.tar.gz"
+
+    # The results and logs can be many files, so if the image has them use
+    # the native tar and pigz instead of walking the tree with tarfile
+
+    if(ctx['native_tar']):
+        with open(tarball, "xb") as tarball_fp:
+            tar = subprocess.Popen(
+                ["tar", "-cf", "-", os.path.basename(dir)], stdout=subprocess.PIPE)
+            pigz = subprocess.Popen(["pigz", "-p", os.getenv('VF_CONTAINER_VCPUS')],
+                                    stdin=tar.stdout, stdout=tarball_fp)
+            tar.stdout.close()
+            pigz.wait()
+            tar.wait()
+
+        if(tar.returncode != 0 or pigz.returncode != 0):
+            logging.error(
+                f"ERR: Cannot generate {tarball}. tar: {tar.returncode}, pigz: {pigz.returncode}")
+            raise(subprocess.CalledProcessError(
+                tar.returncode or pigz.returncode, tar.args))
+    else:
+        with tarfile.open(tarball, "x:gz") as tar:
+            tar.add(os.path.basename(dir))
 
     return os.path.join(str(Path(dir).parents[0]), f"{os.path.basename(dir)}.tar.gz")
 
@@ -791,6 +837,9 @@ def main():
     bucket_name = os.getenv('VF_CONFIG_BUCKET')
     temp_dir_path = os.path.join(os.getenv('VF_TMP_PATH'), '')  
 
+    # Use the native tar and pigz for the output tarballs if they are installed
+    ctx['native_tar'] = shutil.which("tar") != None and shutil.which("pigz") != None
+
     # Get the config information
     ctx['s3'] = boto3.client('s3')
     with tempfile.TemporaryDirectory(prefix=temp_dir_path) as temp_dir:
@@ -432,8 +432,8 @@ def process(config):
                         collection_full_name, collection_count = collection_string
 
                         collection_tranche = collection_full_name[:2]
-                        collection_name, collection_number = collection_full_name.split(
-                            "_", 1)
+                        collection_name, _, collection_number = collection_full_name.partition(
+                            "_")
 
                         collection = collections[collection_full_name]
                         if('status' not in collection):
@@ -539,7 +539,7 @@ def process(config):
 
     # Output all of the information about the workunits into JSON so we can easily grab this data in the future
     with open("../workflow/status.json", "w") as json_out:
-        json.dump(status, json_out)
+        json_out.write(json.dumps(status))
 
 
 def main():
@@ -27,17 +27,17 @@ object_store_input_path="s3://${object_store_bucket_new}/${object_store_job_data
 rm -rf /tmp/vf_input
 mkdir -p /tmp/vf_input/input-files
 cp ${controlfile} /tmp/vf_input/
+# Copy the input files once, leaving out the ligand library since the
+# collections are fetched from the object store by each job
 for file in ../input-files/*; do
-	if [ "${file}" != "ligand-library" ]; then
-		cp -r ../input-files /tmp/vf_input/
+	if [ "$(basename ${file})" != "ligand-library" ]; then
+		cp -r ${file} /tmp/vf_input/input-files/
 	fi
 done
 
-pushd /tmp
-tar cf vf_input.tar vf_input
-gzip vf_input.tar
-popd
-
-cp /tmp/vf_input.tar.gz ../workflow/
+# Write the archive straight into the workflow folder under a temporary name
+# and move it into place instead of building it in /tmp and copying it over
+tar czf ../workflow/vf_input.tar.gz.tmp -C /tmp vf_input
+mv ../workflow/vf_input.tar.gz.tmp ../workflow/vf_input.tar.gz
 
 aws s3 cp ../workflow/vf_input.tar.gz ${object_store_input_path}
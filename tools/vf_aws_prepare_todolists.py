@@ -30,12 +30,52 @@
 
 import tempfile
 import tarfile
+import io
 import os
 import json
 import re
 import boto3
 import logging
 import sys
+import shutil
+import time
+import heapq
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import awscrt.exceptions
+except ImportError:
+    awscrt = None
+
+
+# Number of concurrent requests the transfer manager uses for the uploads
+S3_MAX_CONCURRENCY = 32
+
+# Number of times the upload of a workunit is attempted, and the delay before
+# the first retry (doubled for every retry after that)
+S3_UPLOAD_ATTEMPTS = 5
+S3_RETRY_BASE_DELAY = 1
+
+# S3 error codes that are worth retrying, on top of any 5xx response. Other
+# errors (access denied, missing bucket, bad credentials, ...) would just fail
+# the same way again
+S3_RETRYABLE_ERROR_CODES = {'SlowDown', 'RequestTimeout',
+                            'InternalError', 'ServiceUnavailable'}
+
+# Approximate number of characters of todo.all that are parsed at a time
+TODO_READ_BLOCK_SIZE = 1024 * 1024
+
+# A block of todo.all lines, each being exactly a collection name and a count
+TODO_BLOCK_PATTERN = re.compile(r'(?:[ \t]*\S+[ \t]+\S+[ \t]*(?:\r?\n|\Z))*')
 
 
 def parse_config(filename):
@@ -53,61 +93,256 @@ def parse_config(filename):
     return config
 
 
-def publish_workunit(ctx, index, workunit_subjobs, status):
+def add_tarball_member(out, name, data, mtime):
+
+    member = tarfile.TarInfo(name)
+    member.size = len(data)
+    member.mtime = mtime
+    out.addfile(member, io.BytesIO(data))
+
+
+def write_workunit_tasks(out, workunit_subjobs):
+
+    mtime = time.time()
 
-    # Create a temporary directory
-    temp_dir = tempfile.TemporaryDirectory()
-    temp_dir_tar = tempfile.TemporaryDirectory()
+    tasks_dir = tarfile.TarInfo("vf_tasks")
+    tasks_dir.type = tarfile.DIRTYPE
+    tasks_dir.mode = 0o755
+    tasks_dir.mtime = mtime
+    out.addfile(tasks_dir)
 
     for subjob_index, subjob_key in enumerate(workunit_subjobs):
+        collections = workunit_subjobs[subjob_key]['collections']
 
-        with open(f'{temp_dir.name}/{subjob_index}', 'w') as fp:
-            for collection, collection_count in workunit_subjobs[subjob_key]['collections']:
-                fp.write(f'{collection} {collection_count}\n')
-                status['collections'][collection] = {
-                    'workunit_key': index, 'subjob_key': subjob_index, 'count': collection_count}
+        task_list = "".join(
+            f'{collection} {collection_count}\n' for collection, collection_count in collections)
+        add_tarball_member(
+            out, f"vf_tasks/{subjob_index}", task_list.encode(), mtime)
+        add_tarball_member(
+            out, f"vf_tasks/{subjob_index}.json", json.dumps(collections).encode(), mtime)
 
-        with open(f'{temp_dir.name}/{subjob_index}.json', 'w') as json_out:
-            json.dump(workunit_subjobs[subjob_key]
-                      ['collections'], json_out, indent=4)
 
-    # Generate the tarball
+# The tarball is generated in memory straight from the subjob lists and
+# uploaded from there. How it is compressed is decided once at startup by
+# select_tarball_generator() so the workers do not need to check each time
 
-    out = tarfile.open(f'{temp_dir_tar.name}/{index}.tar.gz', mode='w')
-    out.add(temp_dir.name, arcname="vf_tasks")
-    out.close()
+def generate_workunit_tarball_zstd(workunit_subjobs):
 
-    # Upload it to S3....
-    #
-    object_path = [
-        ctx['config']['object_store_job_data_prefix'],
-        "input",
-        "tasks",
-        f"{index}.tar.gz"
-    ]
-    object_name = "/".join(object_path)
+    tarball = io.BytesIO()
+    with tarfile.open(fileobj=tarball, mode='w') as out:
+        write_workunit_tasks(out, workunit_subjobs)
 
-    try:
-        response = ctx['s3'].upload_file(
-            f'{temp_dir_tar.name}/{index}.tar.gz', ctx['config']['object_store_bucket'], object_name)
-    except ClientError as e:
-        logging.error(e)
+    return zstandard.ZstdCompressor(level=3, threads=0).compress(tarball.getvalue())
 
-    temp_dir.cleanup()
-    temp_dir_tar.cleanup()
 
+def generate_workunit_tarball_gzip(workunit_subjobs):
 
-def process(ctx):
+    tarball = io.BytesIO()
+    with tarfile.open(fileobj=tarball, mode='w:gz') as out:
+        write_workunit_tasks(out, workunit_subjobs)
 
-    config = ctx['config']
+    return tarball.getvalue()
 
-    status = {
-        'overall': {},
-        'workunits': {},
-        'collections': {}
-    }
 
-    workunits = status['workunits']
+def use_crt_transfer_client():
+
+    # boto3 only accepts preferred_transfer_client='crt' from 1.42.0 on (older
+    # releases ignore or reject it), and with it boto3 refuses to start unless
+    # awscrt 0.19.18 or newer is installed (pip install "boto3[crt]>=1.42.0")
+    if(awscrt == None):
+        return False
+
+    boto3_version = tuple(int(part)
+                          for part in boto3.__version__.split(".")[:2])
+    if(boto3_version < (1, 42)):
+        return False
+
+    from boto3.s3.transfer import has_minimum_crt_version
+    return has_minimum_crt_version((0, 19, 18))
+
+
+def select_tarball_generator(config):
+
+    compression = config.get('aws_batch_task_compression', 'gzip')
+
+    if(compression == "zstd"):
+        if(zstandard == None):
+            print("aws_batch_task_compression=zstd requires the zstandard Python package")
+            sys.exit(1)
+        return generate_workunit_tarball_zstd, "tar.zst"
+    elif(compression == "gzip"):
+        return generate_workunit_tarball_gzip, "tar.gz"
+
+    print(
+        f"Unknown aws_batch_task_compression '{compression}' (use gzip or zstd)")
+    sys.exit(1)
+
+
+def todo_format_error(lines, first_line_number):
+
+    # Only called once a block is known to be malformed, so it is fine to go
+    # back and check it line by line to report where the problem is
+    for line_number, line in enumerate(lines, first_line_number):
+        fields = line.split()
+        try:
+            if(len(fields) == 2):
+                int(fields[1])
+                continue
+        except ValueError:
+            pass
+        print(
+            f"templates/todo.all line {line_number}: expected '<collection> <ligand count>', got '{line.rstrip()}'")
+        sys.exit(1)
+
+    print(
+        f"templates/todo.all: cannot parse lines {first_line_number}-{first_line_number + len(lines) - 1}")
+    sys.exit(1)
+
+
+def start_status(ctx):
+
+    # The status file is written out as the workunits are published rather
+    # than kept in memory until the end. The collections section comes after
+    # the workunits, so their entries are spooled to a temporary file and
+    # appended once all of the workunits are written. The file is only moved
+    # into place once everything is uploaded.
+
+    ctx['status_out'] = open("../workflow/status.json.tmp", "w")
+    ctx['status_collections'] = tempfile.TemporaryFile("w+")
+    ctx['status_workunits_written'] = 0
+    ctx['status_collections_written'] = 0
+
+    # The workers are told which tasks extension was actually written, rather
+    # than reading the compression setting back out of vf_input
+    overall = {'tasks_extension': ctx['tasks_extension']}
+    ctx['status_out'].write(
+        '{"overall": ' + json.dumps(overall) + ', "workunits": {')
+
+
+def record_workunit(ctx, index, workunit_subjobs):
+
+    if(ctx['status_workunits_written'] > 0):
+        ctx['status_out'].write(", ")
+    ctx['status_out'].write(
+        f'"{index}": {json.dumps({"subjobs": workunit_subjobs})}')
+    ctx['status_workunits_written'] += 1
+
+    for subjob_index, subjob_key in enumerate(workunit_subjobs):
+        for collection, collection_count in workunit_subjobs[subjob_key]['collections']:
+            if(ctx['status_collections_written'] > 0):
+                ctx['status_collections'].write(", ")
+            ctx['status_collections'].write(json.dumps({collection: {
+                'workunit_key': index, 'subjob_key': subjob_index, 'count': collection_count}})[1:-1])
+            ctx['status_collections_written'] += 1
+
+
+def finish_status(ctx):
+
+    ctx['status_out'].write('}, "collections": {')
+    ctx['status_collections'].seek(0)
+    shutil.copyfileobj(ctx['status_collections'], ctx['status_out'])
+    ctx['status_out'].write('}}')
+
+    ctx['status_collections'].close()
+    ctx['status_out'].close()
+    os.replace("../workflow/status.json.tmp", "../workflow/status.json")
+
+
+def publish_workunit(ctx, index, workunit_subjobs):
+
+    record_workunit(ctx, index, workunit_subjobs)
+
+    # Building the tarball is CPU bound, so hand it off to the process pool
+    tarball = ctx['tar_pool'].submit(
+        ctx['generate_tarball'], workunit_subjobs)
+    ctx['tarballs'].append((index, tarball))
+
+    upload_workunits(ctx)
+
+
+def start_upload(ctx, index, tarball, attempt):
+
+    # Uploads are started in workunit order as the tarballs become ready. All
+    # of the task files share one prefix, and with at most S3_MAX_CONCURRENCY
+    # uploads in flight we stay far below the per prefix request rate of S3,
+    # so reordering them to spread the keys would only delay the uploads
+    object_name = f"{ctx['tasks_object_prefix']}/{index}.{ctx['tasks_extension']}"
+
+    upload = ctx['transfer_mgr'].upload(
+        io.BytesIO(tarball), ctx['config']['object_store_bucket'], object_name)
+    ctx['uploads'].append((index, tarball, attempt, upload))
+
+
+def retryable_upload_error(e):
+
+    # Transport errors (BotoCoreError and AwsCrtError) are always retried,
+    # responses from S3 only if it is throttling us or failed on its side
+    if(not isinstance(e, ClientError)):
+        return True
+
+    error_code = e.response.get('Error', {}).get('Code')
+    status_code = e.response.get(
+        'ResponseMetadata', {}).get('HTTPStatusCode', 0)
+    return error_code in S3_RETRYABLE_ERROR_CODES or status_code >= 500
+
+
+def finish_upload(ctx, index, tarball, attempt, upload):
+
+    try:
+        upload.result()
+    except ctx['upload_errors'] as e:
+        if(attempt >= S3_UPLOAD_ATTEMPTS or not retryable_upload_error(e)):
+            logging.error(e)
+            return
+
+        # Back off exponentially before trying this workunit again. The retry
+        # is queued so we can keep generating and uploading in the meantime
+        delay = S3_RETRY_BASE_DELAY * (2 ** (attempt - 1))
+        logging.warning(
+            f"Upload of workunit {index} failed, retrying in {delay}s ({e})")
+        heapq.heappush(ctx['retries'], (time.monotonic() +
+                       delay, index, tarball, attempt + 1))
+
+
+def upload_workunits(ctx, wait=False):
+
+    # Hand the generated tarballs over to the transfer manager so they are
+    # uploaded to S3 in the background while we keep generating. If too many
+    # workunits are queued up we wait for the oldest ones, so the tarballs
+    # held in memory stay bounded....
+    #
+    tarballs = ctx['tarballs']
+    uploads = ctx['uploads']
+    retries = ctx['retries']
+
+    while(True):
+        now = time.monotonic()
+
+        if(len(tarballs) > 0 and (wait or tarballs[0][1].done())):
+            index, tarball = tarballs.popleft()
+            start_upload(ctx, index, tarball.result(), 1)
+        elif(len(retries) > 0 and retries[0][0] <= now):
+            not_before, index, tarball, attempt = heapq.heappop(retries)
+            start_upload(ctx, index, tarball, attempt)
+        elif(len(uploads) > 0 and (wait or uploads[0][3].done())):
+            finish_upload(ctx, *uploads.popleft())
+        elif(wait or len(tarballs) + len(uploads) + len(retries) > ctx['max_workunits_in_flight']):
+            # Nothing is ready yet, wait for the oldest workunit
+            if(len(uploads) > 0):
+                finish_upload(ctx, *uploads.popleft())
+            elif(len(tarballs) > 0):
+                tarballs[0][1].result()
+            elif(len(retries) > 0):
+                time.sleep(retries[0][0] - now)
+            else:
+                break
+        else:
+            break
+
+
+def process(ctx):
+
+    config = ctx['config']
 
     current_workunit_index = 1
     current_workunit_subjobs = {}
@@ -118,55 +353,74 @@ def process(ctx):
 
     counter = 0
 
-    total_lines = 0
-    with open('templates/todo.all') as fp:
-        for index, line in enumerate(fp):
-            total_lines += 1
-
-    print("Generating jobfiles....")
+    # These are fixed for the whole run so only look them up once rather
+    # than for every collection
+    ligands_todo_per_queue = int(config['ligands_todo_per_queue'])
+    aws_batch_array_job_size = int(config['aws_batch_array_job_size'])
 
-    with open('templates/todo.all') as fp:
-        for index, line in enumerate(fp):
-            collection_name, collection_count = line.split()
+    # Progress is based on how much of the file has been read so we do not
+    # need a separate pass over it just to count the lines
+    total_bytes = os.path.getsize('templates/todo.all')
+    bytes_read = 0
+    lines_read = 0
 
-            collection_count = int(collection_count)
+    print("Generating jobfiles....")
 
-            if(collection_count >= int(config['ligands_todo_per_queue'])):
-                # create a new collection just for this one
-                #current_workunit.append([ (collection_name, collection_count) ])
-                current_workunit_subjobs[current_subjob_index] = {
-                    'collections': [(collection_name, collection_count)]}
-                current_subjob_index += 1
-            else:
-                # add it to the 'leftover pile'
-                leftover_count += collection_count
-                leftover_subjob.append((collection_name, collection_count))
+    start_status(ctx)
 
-                if(leftover_count >= int(config['ligands_todo_per_queue'])):
-                    # current_workunit.append(leftover_subjob)
+    with open('templates/todo.all') as fp:
+        # Read the file in blocks of lines and tokenise each block with a
+        # single split() rather than parsing it line by line
+        for lines in iter(lambda: fp.readlines(TODO_READ_BLOCK_SIZE), []):
+            block = "".join(lines)
+            bytes_read += len(block)
+            tokens = block.split()
+
+            # Every line has to be exactly a collection name and a count, so
+            # check the whole block before pairing up its tokens
+            try:
+                if(TODO_BLOCK_PATTERN.fullmatch(block) == None):
+                    raise ValueError
+                collection_counts = [int(count) for count in tokens[1::2]]
+            except ValueError:
+                todo_format_error(lines, lines_read + 1)
+            lines_read += len(lines)
+
+            for collection_name, collection_count in zip(tokens[0::2], collection_counts):
+                if(collection_count >= ligands_todo_per_queue):
+                    # create a new collection just for this one
+                    #current_workunit.append([ (collection_name, collection_count) ])
                     current_workunit_subjobs[current_subjob_index] = {
-                        'collections': leftover_subjob}
+                        'collections': [(collection_name, collection_count)]}
                     current_subjob_index += 1
-                    leftover_subjob = []
-                    leftover_count = 0
-
-            if(len(current_workunit_subjobs) == int(config['aws_batch_array_job_size'])):
-                publish_workunit(ctx, current_workunit_index,
-                                 current_workunit_subjobs, status)
-                workunits[current_workunit_index] = {
-                    'subjobs': current_workunit_subjobs}
-
-                current_workunit_index += 1
-                current_subjob_index = 0
-                current_workunit_subjobs = {}
-
-            counter += 1
-
-            if(counter % 250 == 0):
-                print(".", end="", file=sys.stderr)
-            if(counter % 2000 == 0):
-                percent = (counter / total_lines) * 100
-                print(f" ({percent: .2f}%)", file=sys.stderr)
+                else:
+                    # add it to the 'leftover pile'
+                    leftover_count += collection_count
+                    leftover_subjob.append((collection_name, collection_count))
+
+                    if(leftover_count >= ligands_todo_per_queue):
+                        # current_workunit.append(leftover_subjob)
+                        current_workunit_subjobs[current_subjob_index] = {
+                            'collections': leftover_subjob}
+                        current_subjob_index += 1
+                        leftover_subjob = []
+                        leftover_count = 0
+
+                if(len(current_workunit_subjobs) == aws_batch_array_job_size):
+                    publish_workunit(ctx, current_workunit_index,
+                                     current_workunit_subjobs)
+
+                    current_workunit_index += 1
+                    current_subjob_index = 0
+                    current_workunit_subjobs = {}
+
+                counter += 1
+
+                if(counter % 250 == 0):
+                    print(".", end="", file=sys.stderr)
+                if(counter % 2000 == 0):
+                    percent = (bytes_read / total_bytes) * 100
+                    print(f" ({percent: .2f}%)", file=sys.stderr)
 
     # If we have leftovers -- process them
     if(leftover_count > 0):
@@ -177,17 +431,20 @@ def process(ctx):
     # If the current workunit has any items in it, we need to publish it
     if(len(current_workunit_subjobs) > 0):
         publish_workunit(ctx, current_workunit_index,
-                         current_workunit_subjobs, status)
-        workunits[current_workunit_index] = {
-            'subjobs': current_workunit_subjobs}
+                         current_workunit_subjobs)
+
+    # Make sure all of the workunits are in S3 before we record them
+    upload_workunits(ctx, wait=True)
 
     print("Writing json")
 
     # Output all of the information about the workunits into JSON so we can easily grab this data in the future
-    with open("../workflow/status.json", "w") as json_out:
-        json.dump(status, json_out)
+    finish_status(ctx)
 
-    os.system('cp ../workflow/status.json ../workflow/status.todolists.json')
+    # Keep a snapshot of the status as it was generated. This needs to be a
+    # real copy since the status file is rewritten in place by the other tools
+    shutil.copyfile('../workflow/status.json',
+                    '../workflow/status.todolists.json')
 
     print(f"Generated {current_workunit_index} workunits")
 
@@ -195,9 +452,67 @@ def process(ctx):
 def main():
 
     ctx = {}
-    ctx['s3'] = boto3.client('s3')
     ctx['config'] = parse_config("../workflow/control/all.ctrl")
-    process(ctx)
+
+    # The connection pool, keepalive and retry settings only apply to requests
+    # made through this client, i.e. the classic transfer manager. The CRT
+    # transfer manager takes little more than the region and credentials from
+    # it and manages its own connections and retries.
+    #
+    # With the classic manager the default pool of 10 connections would cap
+    # the concurrent uploads, so size it well above S3_MAX_CONCURRENCY.
+    # Failed uploads are retried per workunit by finish_upload, so botocore
+    # only makes a single attempt. The adaptive mode is not used, as after a
+    # burst of SlowDown responses its rate limiter drops to about one request
+    # every two seconds and recovers slowly. finish_upload backs off instead.
+    aws_config = Config(
+        region_name=ctx['config']['aws_region'],
+        max_pool_connections=2 * S3_MAX_CONCURRENCY,
+        retries={'total_max_attempts': 1, 'mode': 'standard'},
+        tcp_keepalive=True,
+        s3={'addressing_style': 'virtual'}
+    )
+    ctx['s3'] = boto3.client('s3', config=aws_config)
+
+    # Every workunit tarball is stored under the same prefix
+    object_path = [
+        ctx['config']['object_store_job_data_prefix'],
+        "input",
+        "tasks"
+    ]
+    ctx['tasks_object_prefix'] = "/".join(object_path)
+
+    ctx['generate_tarball'], ctx['tasks_extension'] = select_tarball_generator(
+        ctx['config'])
+
+    # Only options the CRT transfer manager also accepts can go in here, as
+    # any other option set explicitly (even to its default, e.g. use_threads)
+    # makes create_transfer_manager() refuse the config for the CRT client
+    transfer_options = {
+        'max_concurrency': S3_MAX_CONCURRENCY,
+        'multipart_chunksize': 16 * 1024 * 1024
+    }
+    ctx['upload_errors'] = (ClientError, BotoCoreError)
+
+    # Use the AWS CRT based transfer manager when it is installed so the
+    # signing and transfers run natively, otherwise the classic threaded one.
+    # Transport failures of the CRT client are raised as AwsCrtError.
+    if(use_crt_transfer_client()):
+        transfer_options['preferred_transfer_client'] = 'crt'
+        ctx['upload_errors'] += (awscrt.exceptions.AwsCrtError,)
+
+    transfer_config = TransferConfig(**transfer_options)
+
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as tar_pool, \
+            create_transfer_manager(ctx['s3'], transfer_config) as transfer_mgr:
+        ctx['tar_pool'] = tar_pool
+        ctx['transfer_mgr'] = transfer_mgr
+        ctx['tarballs'] = deque()
+        ctx['uploads'] = deque()
+        ctx['retries'] = []
+        ctx['max_workunits_in_flight'] = S3_MAX_CONCURRENCY + \
+            2 * os.cpu_count()
+        process(ctx)
 
 
 if __name__ == '__main__':
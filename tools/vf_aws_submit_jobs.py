@@ -28,13 +28,13 @@
 # ---------------------------------------------------------------------------
 
 
-import os
 import json
 import boto3
 import botocore
 import re
 import argparse
 import sys
+import shutil
 from botocore.config import Config
 
 
@@ -68,6 +68,13 @@ def process(config, start, stop):
         status = json.load(read_file)
         collections = status['collections']
         workunits = status['workunits']
+        tasks_extension = status['overall'].get('tasks_extension', 'tar.gz')
+
+    # These are the same for every jobline
+    number_of_queues = int(config['aws_batch_number_of_queues'])
+
+    # Path to the data files
+    object_store_input_path = f"s3://{config['object_store_bucket']}/{config['object_store_job_data_prefix']}/input/vf_input.tar.gz"
 
     for jobline in range(start, stop + 1):
 
@@ -94,12 +101,9 @@ def process(config, start, stop):
                 if(subjobs_count == 1):
                     subjobs_count = 2
 
-                # Path to the data files
-                object_store_input_path = f"s3://{config['object_store_bucket']}/{config['object_store_job_data_prefix']}/input/vf_input.tar.gz"
-
                 # Which queue to submit to
                 batch_queue_number = (
-                    (jobline - 1) % int(config['aws_batch_number_of_queues'])) + 1
+                    (jobline - 1) % number_of_queues) + 1
 
                 try:
                     response = client.submit_job(
@@ -148,6 +152,10 @@ def process(config, start, stop):
                                 {
                                     'name': 'VF_TMP_PATH',
                                     'value': f"{config['tempdir_fast']}"
+                                },
+                                {
+                                    'name': 'VF_TASKS_EXTENSION',
+                                    'value': tasks_extension
                                 }
                             ]
                         }
@@ -166,9 +174,10 @@ def process(config, start, stop):
 
     # Output all of the information about the workunits into JSON so we can easily grab this data in the future
     with open("../workflow/status.json", "w") as json_out:
-        json.dump(status, json_out, indent=4)
+        json_out.write(json.dumps(status))
 
-    os.system('cp ../workflow/status.json ../workflow/status.submission.json')
+    shutil.copyfile('../workflow/status.json',
+                    '../workflow/status.submission.json')
 
 
 def main():